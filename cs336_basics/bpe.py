@@ -1,22 +1,34 @@
 # cs336_basics/bpe.py
 from collections import Counter
-from typing import List, Tuple, Dict, Iterable
-# from pretokenization_example import find_chunk_boundaries
-import regex as re
+from typing import List, Dict
+from cs336_basics.pretokenization_example import find_chunk_boundaries, pretokenize_chunk
+import heapq
+import multiprocessing as mp
 import os
+import pickle
 
-def pre_tokenization(
-    chunks: Iterable[str]
-) -> Counter[tuple[bytes, ...]]:
-    PAT = r"""'(?:[sdmt]|ll|ve|re)| ?\p{L}+| ?\p{N}+| ?[^\s\p{L}\p{N}]+|\s+(?!\S)|\s+"""
-    token_counts = Counter()
-    for chunk in chunks:
-        for match in re.finditer(PAT, chunk):
-            pre_token = match.group().encode("utf-8")
-            if len(pre_token) != 1:
-                # turn the bytestring object into a tuple of bytestring objects of single byte
-                token_counts[tuple(bytes([x]) for x in pre_token)] += 1
-    return token_counts
+# upper bound on the byte range a single pretokenize_chunk call works on, so
+# large corpora are streamed through the pool in bounded pieces instead of
+# being carved into file_size / num_processes slices
+_TARGET_CHUNK_BYTES = 16 * 1024 * 1024
+
+def _pretokenize_span(args):
+    # starmap-style unpacking shim for Pool.imap_unordered
+    return pretokenize_chunk(*args)
+
+class _ReversedPair:
+    """Wraps a packed (a << 32) | b pair of symbol ids so heapq's min-heap
+    pops the lexicographically greatest pair first among entries with equal
+    count (BPE tie-breaking rule); `key` is the byte spelling the tie is
+    broken on."""
+    __slots__ = ("pair", "key")
+
+    def __init__(self, pair, key):
+        self.pair = pair
+        self.key = key
+
+    def __lt__(self, other):
+        return self.key > other.key
 
 def save_vocab(vocab: dict[int, bytes], filepath: str) -> None:
     os.makedirs(os.path.dirname(filepath), exist_ok=True)
@@ -31,6 +43,27 @@ def save_merges(merges: list[tuple[bytes, bytes]], filepath: str) -> None:
         for a, b in merges:
             f.write(f"{a.hex()} {b.hex()}\n")
 
+# binary counterparts of the hex-text serializers above: much faster and
+# smaller for large vocabs; the text versions are kept for inspection
+
+def save_vocab_bin(vocab: dict[int, bytes], filepath: str) -> None:
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    with open(filepath, "wb") as f:
+        pickle.dump(vocab, f, protocol=5)
+
+def load_vocab_bin(filepath: str) -> dict[int, bytes]:
+    with open(filepath, "rb") as f:
+        return pickle.load(f)
+
+def save_merges_bin(merges: list[tuple[bytes, bytes]], filepath: str) -> None:
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    with open(filepath, "wb") as f:
+        pickle.dump(merges, f, protocol=5)
+
+def load_merges_bin(filepath: str) -> list[tuple[bytes, bytes]]:
+    with open(filepath, "rb") as f:
+        return pickle.load(f)
+
 def train_bpe(
     input_path: str,
     vocab_size: int,
@@ -43,70 +76,171 @@ def train_bpe(
         merges: list of byte-pair tuples representing BPE merges
     """
 
-    with open(input_path, "rb") as f:
-        corpus_bytes = f.read()
-    
-    text = corpus_bytes.decode("utf-8", errors="ignore")
-
     # 1. vocabulary initialization
     vocab_count = 256
     vocab = {i: bytes([i]) for i in range(vocab_count)}
 
-    # 2. removing special tokens
-    escaped_tokens = [re.escape(token) for token in special_tokens]
-    pattern = "|".join(escaped_tokens)
-    chunks = re.split(pattern, text)
-
     vocab.update({vocab_count + i: token.encode("utf-8") for i, token in enumerate(special_tokens)})
     vocab_count += len(special_tokens)
 
-    # 3. pre-tokenization
-    token_counts = pre_tokenization(chunks) 
+    # 2./3. pre-tokenization, parallelized over chunks that start at
+    # special-token boundaries; each worker reads its own byte range so the
+    # corpus is never loaded into the parent process
+    num_processes = os.cpu_count() or 1
+    with open(input_path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        file_size = f.tell()
+        if special_tokens:
+            # ask for enough chunks that no single one exceeds the target
+            # size, so workers stream through big corpora in bounded pieces
+            num_chunks = max(num_processes, -(-file_size // _TARGET_CHUNK_BYTES))
+            boundaries = find_chunk_boundaries(f, num_chunks, special_tokens[0].encode("utf-8"))
+        else:
+            boundaries = [0, file_size]
+    chunk_spans = list(zip(boundaries[:-1], boundaries[1:]))
+
+    # fold each chunk's counts in as soon as it is done, so at most one
+    # finished Counter per worker is ever held alongside the running total
+    token_counts = Counter()
+    if num_processes > 1 and len(chunk_spans) > 1:
+        with mp.Pool(num_processes) as pool:
+            spans = [(input_path, start, end, special_tokens) for start, end in chunk_spans]
+            for counter in pool.imap_unordered(_pretokenize_span, spans):
+                token_counts.update(counter)
+    else:
+        for start, end in chunk_spans:
+            token_counts.update(pretokenize_chunk(input_path, start, end, special_tokens))
 
     # 4. compute BPE merges
     merges = []
-    # 4.1. counts every pair
-    pair_counts = Counter()
+    # pre-tokens are tuples of int symbol ids; sym_bytes maps a symbol id back
+    # to its byte spelling (ids 0-255 are raw bytes, merged symbols follow)
+    sym_bytes = [bytes([i]) for i in range(256)]
+
+    # flatten the distinct pre-tokens into a struct-of-arrays layout: one
+    # contiguous symbol list threaded with prv/nxt links (doubly-linked list,
+    # -1 at word edges), plus the word's count replicated per position. A
+    # merge is then 4 pointer writes at each occurrence instead of rebuilding
+    # the word. Plain lists rather than numpy arrays: the merge loop indexes
+    # from the interpreter, where list item access is far cheaper than
+    # ndarray scalar access
+    sym: List[int] = []
+    prv: List[int] = []
+    nxt: List[int] = []
+    freq_at: List[int] = []
     for pre_token, count in token_counts.items():
-        for left, right in zip(pre_token, pre_token[1:]):
-            pair_counts[(left, right)] += count
+        base = len(sym)
+        n = len(pre_token)
+        # single-symbol pre-tokens can never contribute a pair, so don't
+        # give them slots (pre_tokenization filters these already, but the
+        # layout shouldn't rely on that)
+        if n < 2:
+            continue
+        sym.extend(pre_token)
+        freq_at.extend([count] * n)
+        prv.append(-1)
+        prv.extend(range(base, base + n - 1))
+        nxt.extend(range(base + 1, base + n))
+        nxt.append(-1)
+
+    # 4.1. counts every pair, and record the positions where each pair
+    # occurs (inverted index), so each merge only touches its occurrences; a
+    # plain dict with .get is cheaper than Counter's __missing__ machinery
+    # on this hot path. Pairs are packed into a single int key
+    # (a << 32) | b, which hashes and compares faster than an (int, int)
+    # tuple; symbol ids are far below 2**32
+    pair_counts: Dict[int, int] = {}
+    pair_to_positions: Dict[int, set] = {}
+    for p in range(len(sym)):
+        if nxt[p] != -1:
+            key = (sym[p] << 32) | sym[p+1]
+            pair_counts[key] = pair_counts.get(key, 0) + freq_at[p]
+            pair_to_positions.setdefault(key, set()).add(p)
+
+    # max-heap over (count, pair) with lazy invalidation: every count change
+    # pushes a fresh entry, and stale entries are discarded at pop time by
+    # checking them against the current count
+    heap = [
+        (-count, _ReversedPair(key, (sym_bytes[key >> 32], sym_bytes[key & 0xFFFFFFFF])))
+        for key, count in pair_counts.items()
+    ]
+    heapq.heapify(heap)
+
+    def update_pair_count(key, delta):
+        new_count = pair_counts.get(key, 0) + delta
+        if new_count <= 0:
+            # drop dead pairs so the dict (and stale-entry checks) stay small
+            pair_counts.pop(key, None)
+        else:
+            pair_counts[key] = new_count
+            heapq.heappush(
+                heap, (-new_count, _ReversedPair(key, (sym_bytes[key >> 32], sym_bytes[key & 0xFFFFFFFF])))
+            )
 
     for index in range(vocab_size - vocab_count):
         # 4.1. identify the pair with the highest frequency
-        if not pair_counts:
+        best_key = None
+        while heap:
+            neg_count, wrapped = heapq.heappop(heap)
+            if -neg_count == pair_counts.get(wrapped.pair, 0):
+                best_key = wrapped.pair
+                break
+        if best_key is None:
             break
-        best_pair = max(pair_counts, key=lambda k: (pair_counts[k], k))
-        merges.append(best_pair)
-        new_merge_token = best_pair[0] + best_pair[1]
-        # 4.2. merge the pair in `pre_token`
-        for pre_token, count in list(token_counts.items()):
-            new_tokens = []
-            i = 0
-            merge = False
-            length = len(pre_token)
-            while i < length:
-                if i < length-1 and (pre_token[i], pre_token[i+1]) == best_pair:
-                    new_tokens.append(pre_token[i] + pre_token[i+1])
-                    merge = True
-                    # 4.1. update `pair_count`
-                    if i > 0:
-                        pair_counts[(pre_token[i-1], new_merge_token)] += count
-                        pair_counts[(pre_token[i-1], pre_token[i])] -= count
-                    if i < length-2:
-                        pair_counts[(new_merge_token, pre_token[i+2])] += count
-                        pair_counts[(pre_token[i+1], pre_token[i+2])] -= count
-                    i += 2
-                else:
-                    new_tokens.append(pre_token[i])
-                    i += 1
-            if merge:
-                token_counts[tuple(new_tokens)] += token_counts[pre_token]
-                del token_counts[pre_token]
+        a = best_key >> 32
+        b = best_key & 0xFFFFFFFF
+        merges.append((sym_bytes[a], sym_bytes[b]))
+        # allocate a fresh symbol id for the merged pair
+        new_merge_token = len(sym_bytes)
+        sym_bytes.append(sym_bytes[a] + sym_bytes[b])
+        # 4.2. merge the pair with O(1) pointer surgery at each recorded
+        # occurrence. The position set is popped from the index wholesale
+        # (best_pair's entry is dead after this merge anyway) and visited
+        # left-to-right so overlapping occurrences (e.g. "aaa") resolve
+        # leftmost-first, like the scan-based rewrite did
+        for p in sorted(pair_to_positions.pop(best_key, ())):
+            q = nxt[p]
+            # stale position: consumed by a previous overlapping merge
+            if sym[p] != a or q == -1 or sym[q] != b:
+                continue
+            count = freq_at[p]
+            left = prv[p]
+            right = nxt[q]
+            # 4.1. update `pair_count` and the index for the up to two
+            # neighboring pairs this merge destroys and creates; sym[left]
+            # is live, so back-to-back merges are accounted against the
+            # already-merged symbol
+            if left != -1:
+                left_shifted = sym[left] << 32
+                update_pair_count(left_shifted | new_merge_token, count)
+                update_pair_count(left_shifted | a, -count)
+                positions = pair_to_positions.get(left_shifted | a)
+                if positions is not None:
+                    positions.discard(left)
+                    if not positions:
+                        del pair_to_positions[left_shifted | a]
+                pair_to_positions.setdefault(left_shifted | new_merge_token, set()).add(left)
+            if right != -1:
+                right_sym = sym[right]
+                update_pair_count((new_merge_token << 32) | right_sym, count)
+                update_pair_count((b << 32) | right_sym, -count)
+                positions = pair_to_positions.get((b << 32) | right_sym)
+                if positions is not None:
+                    positions.discard(q)
+                    if not positions:
+                        del pair_to_positions[(b << 32) | right_sym]
+                pair_to_positions.setdefault((new_merge_token << 32) | right_sym, set()).add(p)
+                prv[right] = p
+            sym[p] = new_merge_token
+            nxt[p] = right
+            sym[q] = -1
         # 4.3. add the new merged token to the vocabulary
-        vocab.update({vocab_count: new_merge_token})
+        vocab.update({vocab_count: sym_bytes[new_merge_token]})
         vocab_count += 1
-        # 4.1. update `pair_count`
-        del pair_counts[best_pair]
+        # 4.1. retire the merged pair; pop rather than del since overlapping
+        # occurrences can already have driven its count to zero and out of
+        # the dict via update_pair_count
+        pair_counts.pop(best_key, None)
 
     return vocab, merges
 
@@ -120,6 +254,8 @@ def main():
 
     save_vocab(vocab, f"result/{data_name}/vocab.txt")
     save_merges(merges, f"result/{data_name}/merges.txt")
+    save_vocab_bin(vocab, f"result/{data_name}/vocab.pkl")
+    save_merges_bin(merges, f"result/{data_name}/merges.pkl")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
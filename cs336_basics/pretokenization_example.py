@@ -1,32 +1,71 @@
+import functools
+import mmap
 import os
 import regex as re
-from typing import BinaryIO
+from typing import BinaryIO, Iterable
 from collections import Counter
 
+# GPT-2 pre-tokenization pattern, compiled once at import time so every chunk
+# reuses the same compiled object instead of hitting regex's pattern cache.
+# The ASCII variant spells the character classes out ([A-Za-z], [0-9]), which
+# matches the str pattern exactly on ASCII input while skipping the Unicode
+# property machinery as well as the UTF-8 decode of the chunk and the
+# re-encode of every match; non-ASCII chunks must go through the str pattern,
+# since a bytes pattern cannot group multi-byte characters
+_PRE_TOK_RE = re.compile(r"""'(?:[sdmt]|ll|ve|re)| ?\p{L}+| ?\p{N}+| ?[^\s\p{L}\p{N}]+|\s+(?!\S)|\s+""")
+_PRE_TOK_RE_ASCII = re.compile(rb"""'(?:[sdmt]|ll|ve|re)| ?[A-Za-z]+| ?[0-9]+| ?[^\sA-Za-z0-9]+|\s+(?!\S)|\s+""")
+
+@functools.lru_cache
+def _special_token_splitter(special_tokens: tuple[str, ...]):
+    # byte-level pattern: splitting the raw bytes avoids decoding the special
+    # tokens' surroundings twice and lets callers decode chunk-by-chunk.
+    # Longest alternative first, so a special token that is a prefix of
+    # another (e.g. <|end|> vs <|endoftext|>) can't shadow the longer match
+    escaped = sorted((re.escape(token.encode("utf-8")) for token in special_tokens), key=len, reverse=True)
+    return re.compile(b"|".join(escaped))
+
+def pre_tokenization(
+    chunks: Iterable[bytes]
+) -> Counter[tuple[int, ...]]:
+    token_counts = Counter()
+    for chunk in chunks:
+        if chunk.isascii():
+            for match in _PRE_TOK_RE_ASCII.finditer(chunk):
+                pre_token = match.group()
+                if len(pre_token) != 1:
+                    # turn the bytestring into a tuple of small-int symbol ids
+                    # (0-255); merged symbols get ids >= 256 during training
+                    token_counts[tuple(pre_token)] += 1
+        else:
+            for match in _PRE_TOK_RE.finditer(chunk.decode("utf-8", errors="ignore")):
+                pre_token = match.group().encode("utf-8")
+                if len(pre_token) != 1:
+                    token_counts[tuple(pre_token)] += 1
+    return token_counts
+
 def pretokenize_chunk(
-    input_path: str, 
+    input_path: str,
     start: int,
     end: int,
     special_tokens: list[str]
-) -> Counter[tuple[bytes, ...]]:
+) -> Counter[tuple[int, ...]]:
+    if start >= end:
+        return Counter()
+
+    # memory-map the file so worker processes share the corpus through the OS
+    # page cache instead of each holding a private read() copy
     with open(input_path, "rb") as f:
-        f.seek(start)
-        text = f.read(end - start).decode("utf-8", errors="ignore")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            data = mm[start:end]
 
-    # 2. removing special tokens
-    escaped_tokens = [re.escape(token) for token in special_tokens]
-    pattern = "|".join(escaped_tokens)
-    chunks = re.split(pattern, text)
+    # 2. removing special tokens, at the byte level; pre_tokenization works
+    # on the byte chunks directly and only decodes the non-ASCII ones
+    if special_tokens:
+        byte_chunks = _special_token_splitter(tuple(special_tokens)).split(data)
+    else:
+        byte_chunks = [data]
 
-    PAT = r"""'(?:[sdmt]|ll|ve|re)| ?\p{L}+| ?\p{N}+| ?[^\s\p{L}\p{N}]+|\s+(?!\S)|\s+"""
-    token_counts = Counter()
-    for chunk in chunks:
-        for match in re.finditer(PAT, chunk):
-            pre_token = match.group().encode("utf-8")
-            if len(pre_token) != 1:
-                # turn the bytestring object into a tuple of bytestring objects of single byte
-                token_counts[tuple(bytes([x]) for x in pre_token)] += 1
-    return token_counts
+    return pre_tokenization(byte_chunks)
 
 def find_chunk_boundaries(
     file: BinaryIO,